@@ -4,72 +4,173 @@
 """
 
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # 只保存图像文件，不需要加载GUI后端
 import matplotlib.pyplot as plt
 import numpy as np
 
-# 读取CSV文件
-df = pd.read_csv('llc_stats.csv')
-
-# 存储所有点的坐标
-x_points = []  # 预测值 (E_hat)
-y_points = []  # 实际值 (E)
-
-# 每两行作为一组进行处理
-for i in range(0, len(df) - 1, 2):
-    row1 = df.iloc[i]  # 第一行
-    row2 = df.iloc[i + 1]  # 第二行
-    
-    # 提取属性
-    L1 = row1['little_law_lifetime']
-    L2 = row2['little_law_lifetime']
-    W1 = row1['period_avg_way_occupancy']
-    W2 = row2['period_avg_way_occupancy']
-    E1 = row1['period_total_evictions_caused']
-    E2 = row2['period_total_evictions_caused']
-    E2_1 = row1['period_evictions_caused']  # 第一行的 period_evictions_caused
-    E1_2 = row2['period_evictions_caused']  # 第二行的 period_evictions_caused
-    
-    # 计算分母
+# 分块读取CSV的行数（须为偶数，保证行对不跨块）
+CHUNK_ROWS = 200000
+# 保留用于绘图的点数上限
+PLOT_POINTS_CAP = 1000000
+# 超过该点数时用 hexbin 代替散点图
+HEXBIN_THRESHOLD = 100000
+# 散点图最多绘制的点数，超出时随机抽样（相关系数仍由全部点计算）
+SCATTER_MAX_POINTS = 20000
+
+
+def chunk_stats(x_points, y_points):
+    """
+    计算一块点的中心化统计量（中心化后再求点积，避免均值远大于离散程度时的精度损失）
+
+    Returns:
+        (n, mean_x, mean_y, M2_x, M2_y, C_xy) 元组，M2 为离差平方和，C_xy 为离差积之和
+    """
+    mean_x = x_points.mean()
+    mean_y = y_points.mean()
+    xc = x_points - mean_x
+    yc = y_points - mean_y
+    return len(x_points), mean_x, mean_y, xc @ xc, yc @ yc, xc @ yc
+
+
+def merge_stats(a, b):
+    """按 Chan 等人的成对合并公式合并两组中心化统计量"""
+    n_a, mean_x_a, mean_y_a, m2_x_a, m2_y_a, c_xy_a = a
+    n_b, mean_x_b, mean_y_b, m2_x_b, m2_y_b, c_xy_b = b
+    n = n_a + n_b
+    delta_x = mean_x_b - mean_x_a
+    delta_y = mean_y_b - mean_y_a
+    weight = n_a * n_b / n
+    return (n,
+            mean_x_a + delta_x * n_b / n,
+            mean_y_a + delta_y * n_b / n,
+            m2_x_a + m2_x_b + delta_x * delta_x * weight,
+            m2_y_a + m2_y_b + delta_y * delta_y * weight,
+            c_xy_a + c_xy_b + delta_x * delta_y * weight)
+
+
+def pearson_from_stats(n, mean_x, mean_y, m2_x, m2_y, c_xy):
+    """由中心化统计量计算皮尔逊相关系数"""
+    return float(c_xy / np.sqrt(m2_x * m2_y))
+
+
+def compute_points(data):
+    """
+    由偶数行的数据块计算所有点，每两行作为一组进行处理
+
+    Args:
+        data: (行数, 4) 数组，列顺序与 COLUMNS 一致
+
+    Returns:
+        (2, N) 数组，第0行为预测值 (E_hat)，第1行为实际值 (E)
+    """
+    L, W, E, E_caused = data.T
+
+    # 提取属性：偶数行为第一行，奇数行为第二行
+    L1, L2 = L[0::2], L[1::2]
+    W1, W2 = W[0::2], W[1::2]
+    E1, E2 = E[0::2], E[1::2]
+    E2_1 = E_caused[0::2]  # 第一行的 period_evictions_caused
+    E1_2 = E_caused[1::2]  # 第二行的 period_evictions_caused
+
+    # 计算分母，并避免除以零
     denominator = L1 * W2 + L2 * W1
-    
-    # 避免除以零
-    if denominator == 0:
+    valid = denominator != 0
+    L1, L2, W1, W2, E1, E2 = L1[valid], L2[valid], W1[valid], W2[valid], E1[valid], E2[valid]
+    E2_1, E1_2, denominator = E2_1[valid], E1_2[valid], denominator[valid]
+
+    # 所有点 (E2_1_hat, E2_1) 和 (E1_2_hat, E1_2)，x/y 共用一块预分配的 (2, N) 缓冲区
+    n_pairs = len(denominator)
+    points = np.empty((2, 2 * n_pairs))
+    x_points, y_points = points
+
+    # 计算预测值，直接写入缓冲区，不产生中间数组
+    E2_1_hat = x_points[:n_pairs]  # 预测的 E2-1
+    np.multiply(L1, W2, out=E2_1_hat)
+    E2_1_hat /= denominator
+    E2_1_hat *= E1
+    E1_2_hat = x_points[n_pairs:]  # 预测的 E1-2
+    np.multiply(L2, W1, out=E1_2_hat)
+    E1_2_hat /= denominator
+    E1_2_hat *= E2
+
+    # 实际值 (E)
+    y_points[:n_pairs] = E2_1
+    y_points[n_pairs:] = E1_2
+    return points
+
+
+# 分块读取CSV文件（只读取需要的数值列），逐块计算中心化统计量并合并，
+# 内存占用与文件大小无关。绘图只保留随机抽样的点：保留的点数超过
+# PLOT_POINTS_CAP 时随机丢弃一半，并把后续数据块的抽样概率减半。
+COLUMNS = ['little_law_lifetime', 'period_avg_way_occupancy',
+           'period_total_evictions_caused', 'period_evictions_caused']
+rng = np.random.default_rng(0)
+stats = (0, 0.0, 0.0, 0.0, 0.0, 0.0)  # (n, mean_x, mean_y, M2_x, M2_y, C_xy)
+max_val = -np.inf  # 所有点的最大值
+axis_min = np.full(2, np.inf)  # 预测值、实际值各自的最小值
+kept = []  # 抽样保留的点，每项为 (2, M) 数组
+n_kept = 0
+keep_prob = 1.0
+
+reader = pd.read_csv('llc_stats.csv', usecols=COLUMNS, dtype=np.float64, engine='c',
+                     chunksize=CHUNK_ROWS)
+for chunk in reader:
+    data = chunk[COLUMNS].to_numpy()
+    # CHUNK_ROWS 为偶数，行对不会跨块；奇数行数时丢弃最后一行
+    data = data[:len(data) // 2 * 2]
+    points = compute_points(data)
+    if points.shape[1] == 0:
         continue
-    
-    # 计算预测值
-    E2_1_hat = E1 * (L1 * W2 / denominator)  # 预测的 E2-1
-    E1_2_hat = E2 * (L2 * W1 / denominator)  # 预测的 E1-2
-    
-    # 添加点 (E2_1_hat, E2_1) 和 (E1_2_hat, E1_2)
-    x_points.append(E2_1_hat)
-    y_points.append(E2_1)
-    x_points.append(E1_2_hat)
-    y_points.append(E1_2)
-
-# 转换为numpy数组
-x_points = np.array(x_points)
-y_points = np.array(y_points)
-
-# 计算皮尔逊相关系数
-correlation_matrix = np.corrcoef(x_points, y_points)
-r = correlation_matrix[0, 1]
+
+    # 合并本块的中心化统计量，用于计算皮尔逊相关系数
+    stats = merge_stats(stats, chunk_stats(*points))
+
+    max_val = max(max_val, points.max())
+    np.minimum(axis_min, points.min(axis=1), out=axis_min)
+
+    if keep_prob < 1.0:
+        points = points[:, rng.random(points.shape[1]) < keep_prob]
+    kept.append(points)
+    n_kept += points.shape[1]
+    if n_kept > PLOT_POINTS_CAP:
+        points = np.concatenate(kept, axis=1)
+        points = points[:, rng.random(points.shape[1]) < 0.5]
+        kept = [points]
+        n_kept = points.shape[1]
+        keep_prob /= 2
+
+n_points = stats[0]
+x_points, y_points = np.concatenate(kept, axis=1)
+r = pearson_from_stats(*stats)
 r_squared = r ** 2
 
 # 创建图形
 plt.figure(figsize=(10, 10))
 
-# 绘制散点图
-plt.scatter(x_points, y_points, alpha=0.5, s=20, c='steelblue', label='Data Points')
+# 绘制散点图（栅格化，避免逐点矢量渲染）；点数过多时改用六边形分箱聚合
+n_plotted = len(x_points)
+if n_plotted > HEXBIN_THRESHOLD:
+    positive = (x_points > 0) & (y_points > 0)  # 对数坐标下无法分箱0值
+    plt.hexbin(x_points[positive], y_points[positive], xscale='log', yscale='log',
+               bins='log', cmap='Blues', label='Data Points')
+    n_plotted = int(positive.sum())
+else:
+    xp, yp = x_points, y_points
+    if n_plotted > SCATTER_MAX_POINTS:
+        idx = rng.choice(n_plotted, SCATTER_MAX_POINTS, replace=False)
+        xp, yp = x_points[idx], y_points[idx]
+        n_plotted = SCATTER_MAX_POINTS
+    plt.scatter(xp, yp, alpha=0.5, s=20, c='steelblue', label='Data Points',
+                rasterized=True)
 
 # 使用对数坐标轴让数据点分布更均匀
 plt.xscale('log')
 plt.yscale('log')
 
 # 绘制 y=x 直线（对数坐标下）
-max_val = max(x_points.max(), y_points.max())
-min_val = max(x_points.min(), y_points.min(), 1)  # 避免对数坐标下的0值问题
-line_range = np.logspace(np.log10(min_val), np.log10(max_val), 100)
-plt.plot(line_range, line_range, 'r-', linewidth=2, label='y = x')
+min_val = max(axis_min.max(), 1)  # 避免对数坐标下的0值问题
+plt.plot([min_val, max_val], [min_val, max_val], 'r-', linewidth=2, label='y = x')
 
 # 设置标签和标题
 plt.xlabel(r'Predicted Evictions ($\hat{E}$)', fontsize=12)
@@ -90,9 +191,8 @@ plt.grid(True, alpha=0.3, which='both')
 # 保存图像
 plt.tight_layout()
 plt.savefig('evictions_comparison.png', dpi=150)
-plt.show()
 
-print(f"共绘制了 {len(x_points)} 个点")
+print(f"共计算了 {n_points} 个点，绘制了其中 {n_plotted} 个")
 print(f"皮尔逊相关系数 r = {r:.4f}")
 print(f"决定系数 r² = {r_squared:.4f}")
 print(f"图像已保存为 evictions_comparison.png")
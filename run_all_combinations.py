@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 """
 批量运行ChampSim模拟器，遍历所有trace文件的两两组合
-使用多进程并行运行以提高效率
+使用线程池并行调度ChampSim子进程以提高效率
 """
 
 import os
 import sys
-import glob
+import errno
+import shutil
+import tempfile
 import subprocess
 import itertools
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Iterator, Optional
 import argparse
+import queue
+import threading
 import time
 
 # 配置参数
@@ -19,47 +24,69 @@ PROJECT_ROOT = Path(__file__).parent.resolve()
 CHAMPSIM_BIN = PROJECT_ROOT / "bin" / "champsim"
 DEFAULT_TRACES_DIR = PROJECT_ROOT / "traces"
 DEFAULT_STATS_DIR = PROJECT_ROOT / "stats"
+# ChampSim先把结果写到本地的快速文件系统，完成后再移动到统计目录
+DEFAULT_SCRATCH_DIR = Path("/dev/shm") if os.path.isdir("/dev/shm") else Path(tempfile.gettempdir())
 DEFAULT_WARMUP = 200000000
 DEFAULT_SIMULATION = 500000000
 DEFAULT_WORKERS = 8
+MAX_IN_FLIGHT_PER_WORKER = 2  # 每个工作线程最多排队的任务数
+TRACE_SUFFIXES = (".champsimtrace.xz", ".trace.xz")
+# ChampSim写出的CSV表头（见 src/ooo_cpu.cc），表头与第一行数据在同一次写入中完成
+LLC_STATS_CSV_HEADER = (
+    "heartbeat,cpu,global_cycle,cpu_cycle,instructions,ipc,"
+    "period_accesses,period_misses,period_miss_rate,"
+    "period_evictions_caused,period_evicted_by_others,"
+    "period_avg_lifetime_cycles,period_eviction_count,"
+    "period_avg_way_occupancy,period_total_evictions_caused,"
+    "little_law_lifetime,period_fill_count\n"
+)
+# 不超过表头长度的结果文件（空文件或只有表头）不含任何数据，--skip-existing 时重新运行
+MIN_CSV_BYTES = len(LLC_STATS_CSV_HEADER)
 
 
 def get_trace_files(traces_dir: Path) -> list:
     """获取traces目录下所有的trace文件"""
-    # 支持 .champsimtrace.xz 和 .trace.xz 格式
-    patterns = [
-        str(traces_dir / "*.champsimtrace.xz"),
-        str(traces_dir / "*.trace.xz")
-    ]
-    files = []
-    for pattern in patterns:
-        files.extend(glob.glob(pattern))
-    return sorted(set(files))
+    # 支持 .champsimtrace.xz 和 .trace.xz 格式，单次遍历目录
+    with os.scandir(traces_dir) as entries:
+        return sorted(entry.path for entry in entries
+                      if entry.is_file() and entry.name.endswith(TRACE_SUFFIXES))
 
 
 def get_trace_name(trace_path: str) -> str:
     """从trace文件路径中提取简短名称（不含扩展名）"""
     basename = os.path.basename(trace_path)
     # 移除各种可能的后缀
-    for suffix in [".champsimtrace.xz", ".trace.xz"]:
+    for suffix in TRACE_SUFFIXES:
         if basename.endswith(suffix):
             return basename[:-len(suffix)]
     return basename
 
 
+def move_into_place(src: Path, dst: str) -> None:
+    """将文件原子地移动到目标路径；跨文件系统时先复制到目标目录下的临时文件再重命名"""
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        staged = f"{dst}.{os.getpid()}.tmp"
+        shutil.copyfile(src, staged)
+        os.replace(staged, dst)
+        os.remove(src)
+
+
 def run_simulation(args_tuple: tuple) -> dict:
     """
     运行单个模拟任务
     
     Args:
-        args_tuple: (trace1_path, trace2_path, output_csv_path, champsim_bin, warmup, simulation) 元组
+        args_tuple: (trace1_path, trace2_path, trace1_name, trace2_name, output_csv_path,
+                     scratch_dir, cmd_prefix) 元组，cmd_prefix 为所有任务共用的命令前缀
     
     Returns:
         包含任务结果信息的字典
     """
-    trace1, trace2, output_csv, champsim_bin, warmup, simulation = args_tuple
-    trace1_name = get_trace_name(trace1)
-    trace2_name = get_trace_name(trace2)
+    trace1, trace2, trace1_name, trace2_name, output_csv, scratch_dir, cmd_prefix = args_tuple
     
     result = {
         "trace1": trace1_name,
@@ -72,77 +99,187 @@ def run_simulation(args_tuple: tuple) -> dict:
     
     start_time = time.time()
     
+    # 先输出到临时目录，成功后再移动到统计目录，避免未完成的文件被 --skip-existing 当作已完成
+    tmp_csv = Path(scratch_dir) / f"{os.path.basename(output_csv)}.{os.getpid()}.tmp"
+    
     # 构建命令，使用 --csv-output 参数指定输出路径
-    cmd = [
-        str(champsim_bin),
-        "--warmup-instructions", str(warmup),
-        "--simulation-instructions", str(simulation),
-        "--csv-output", output_csv,
-        trace1,
-        trace2
-    ]
+    cmd = [*cmd_prefix, "--csv-output", str(tmp_csv), trace1, trace2]
     
     try:
-        # 运行champsim
+        # 运行champsim，只保留stderr用于报错，stdout直接丢弃以免在内存中缓存全部输出
         process = subprocess.run(
             cmd,
-            capture_output=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             text=True,
             timeout=36000  # 10小时超时
         )
         
-        # 检查是否成功生成了CSV文件
-        if os.path.exists(output_csv):
-            result["success"] = True
+        # 只有ChampSim正常退出且生成了CSV文件时才移动到统计目录，
+        # 异常退出留下的不完整文件由 finally 删除
+        if process.returncode != 0:
+            result["error"] = f"ChampSim exited abnormally. Return code: {process.returncode}"
+        elif not tmp_csv.exists():
+            result["error"] = "CSV file not generated. Return code: 0"
         else:
-            result["error"] = f"CSV file not generated. Return code: {process.returncode}"
-            if process.stderr:
-                result["error"] += f"\nStderr: {process.stderr[:500]}"
+            move_into_place(tmp_csv, output_csv)
+            result["success"] = True
+        if result["error"] and process.stderr:
+            result["error"] += f"\nStderr: {process.stderr[-500:]}"
                 
     except subprocess.TimeoutExpired:
         result["error"] = "Simulation timed out (>10 hours)"
     except Exception as e:
         result["error"] = str(e)
+    finally:
+        # 清理失败任务可能留下的不完整输出
+        if tmp_csv.exists():
+            tmp_csv.unlink()
     
     result["duration"] = time.time() - start_time
     return result
 
 
-def generate_task_list(traces: list, stats_dir: Path, champsim_bin: Path, 
-                       warmup: int, simulation: int) -> list:
+def generate_task_list(traces: list, stats_dir: Path, scratch_dir: Path, champsim_bin: Path,
+                       warmup: int, simulation: int,
+                       trace_inputs: Optional[dict] = None) -> Iterator[tuple]:
     """
-    生成所有任务列表
+    按需逐个生成任务，不在内存中保存全部组合
     
     Args:
         traces: trace文件路径列表
         stats_dir: 统计文件输出目录
+        scratch_dir: 模拟过程中临时输出文件所在目录
         champsim_bin: champsim可执行文件路径
         warmup: 预热指令数
         simulation: 模拟指令数
+        trace_inputs: trace路径 -> 实际传给ChampSim的路径（如预先解压的文件），缺省时使用原路径
+    
+    Yields:
+        任务元组
+    """
+    # 每个trace的简短名称只计算一次
+    names = {trace: get_trace_name(trace) for trace in traces}
+    inputs = trace_inputs or {}
+    
+    # 所有任务共用的命令前缀
+    cmd_prefix = (
+        str(champsim_bin),
+        "--warmup-instructions", str(warmup),
+        "--simulation-instructions", str(simulation),
+    )
+    scratch_dir = str(scratch_dir)
+    
+    # 按下标间隔 k 依次生成所有两两组合 (traces[i], traces[i+k])，而不是
+    # itertools.combinations 的三角顺序：相邻调度的任务很少共用同一个trace，
+    # 避免多个工作线程同时解压读取同一个文件
+    for k in range(1, len(traces)):
+        for trace1, trace2 in zip(traces, traces[k:]):
+            name1 = names[trace1]
+            name2 = names[trace2]
+            output_csv = str(stats_dir / f"{name1}+{name2}.csv")
+            yield (inputs.get(trace1, trace1), inputs.get(trace2, trace2), name1, name2, output_csv,
+                   scratch_dir, cmd_prefix)
+
+
+def get_uncompressed_size(trace_path: str) -> Optional[int]:
+    """从xz文件索引中读取解压后的大小，无法读取时返回None"""
+    process = subprocess.run(["xz", "--robot", "--list", trace_path],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    for line in process.stdout.splitlines():
+        fields = line.split("\t")
+        if fields[0] == "totals":
+            return int(fields[4])
+    return None
+
+
+def decompress_traces(traces: Iterable[str], decompress_dir: Path,
+                      cap_bytes: Optional[int], workers: int) -> dict:
+    """
+    将trace预先解压到本地目录，每个trace只解压一次，供它参与的所有组合复用
+    
+    Args:
+        traces: 需要解压的trace文件路径
+        decompress_dir: 解压目录，其中已有的解压文件直接复用
+        cap_bytes: 解压文件总大小上限，超出上限的trace不解压；None表示不限制
+        workers: 并行解压的线程数
     
     Returns:
-        任务元组列表
+        trace路径 -> 传给ChampSim的路径 的字典，未解压的trace仍使用原压缩文件
     """
-    tasks = []
+    selected = []
+    total_bytes = 0
+    for trace in traces:
+        size = get_uncompressed_size(trace)
+        if size is None or (cap_bytes is not None and total_bytes + size > cap_bytes):
+            continue
+        total_bytes += size
+        # 去掉 .xz 后缀，ChampSim按未压缩文件读取
+        selected.append((trace, decompress_dir / os.path.basename(trace)[:-len(".xz")]))
     
-    # 生成所有两两组合
-    for trace1, trace2 in itertools.combinations(traces, 2):
-        name1 = get_trace_name(trace1)
-        name2 = get_trace_name(trace2)
-        output_csv = str(stats_dir / f"{name1}+{name2}.csv")
-        tasks.append((trace1, trace2, output_csv, str(champsim_bin), warmup, simulation))
+    def decompress(item: tuple) -> tuple:
+        trace, target = item
+        if target.exists():
+            return trace, target
+        # 先解压到临时文件，完成后再重命名，避免留下不完整的解压文件
+        tmp_target = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_target, "wb") as out:
+                process = subprocess.run(["xz", "-dc", trace], stdout=out, stderr=subprocess.DEVNULL)
+            if process.returncode == 0:
+                os.replace(tmp_target, target)
+                return trace, target
+        except OSError:
+            # 无法创建或写入解压文件（权限、磁盘空间不足等）时退回使用压缩文件
+            pass
+        tmp_target.unlink(missing_ok=True)
+        return trace, None
     
-    return tasks
+    os.makedirs(decompress_dir, exist_ok=True)
+    inputs = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for trace, target in executor.map(decompress, selected):
+            if target is not None:
+                inputs[trace] = str(target)
+    return inputs
 
 
-def filter_existing_tasks(tasks: list) -> list:
-    """过滤掉已经存在结果的任务"""
-    filtered = []
-    for task in tasks:
-        output_csv = task[2]
-        if not os.path.exists(output_csv):
-            filtered.append(task)
-    return filtered
+def filter_existing_tasks(tasks: Iterable[tuple], stats_dir: Path) -> Iterator[tuple]:
+    """过滤掉已经存在结果的任务（只遍历一次输出目录，空文件或只有表头的文件不算已完成）"""
+    existing = set()
+    if stats_dir.exists():
+        with os.scandir(stats_dir) as entries:
+            existing = {entry.name for entry in entries
+                        if entry.is_file() and entry.stat().st_size > MIN_CSV_BYTES}
+    return (task for task in tasks if os.path.basename(task[4]) not in existing)
+
+
+def print_progress(progress: queue.Queue, num_tasks: int, start_time: float, workers: int) -> None:
+    """
+    输出线程：依次打印完成任务的进度信息，直到从队列中取到None
+    
+    Args:
+        progress: (已完成任务数, 任务结果字典) 元组的队列
+        num_tasks: 任务总数
+        start_time: 开始运行的时间
+        workers: 并行任务数，用于估算剩余时间
+    """
+    while True:
+        item = progress.get()
+        if item is None:
+            break
+        completed, result = item
+        status = "✓" if result["success"] else "✗"
+        
+        elapsed = time.time() - start_time
+        avg_time = elapsed / completed if completed > 0 else 0
+        remaining = (num_tasks - completed) * avg_time / workers
+        
+        print(f"[{completed:4d}/{num_tasks}] {status} {result['trace1']} + {result['trace2']} "
+              f"({result['duration']:.1f}s) - 预计剩余: {remaining/60:.1f}分钟")
+        
+        if not result["success"]:
+            print(f"         错误: {result['error']}")
 
 
 def main():
@@ -154,7 +291,7 @@ def main():
   python run_all_combinations.py --dry-run                    # 预览任务
   python run_all_combinations.py --limit 10                   # 只运行10个任务（测试）
   python run_all_combinations.py --skip-existing              # 跳过已有结果
-  python run_all_combinations.py --workers 4                  # 使用4个并行进程
+  python run_all_combinations.py --workers 4                  # 使用4个并行线程
         """
     )
     parser.add_argument(
@@ -169,11 +306,17 @@ def main():
         default=str(DEFAULT_STATS_DIR),
         help=f"统计结果输出目录 (默认: {DEFAULT_STATS_DIR})"
     )
+    parser.add_argument(
+        "--scratch-dir",
+        type=str,
+        default=str(DEFAULT_SCRATCH_DIR),
+        help=f"模拟过程中临时输出文件目录，建议使用本地快速文件系统 (默认: {DEFAULT_SCRATCH_DIR})"
+    )
     parser.add_argument(
         "--workers",
         type=int,
         default=DEFAULT_WORKERS,
-        help=f"并行工作进程数 (默认: {DEFAULT_WORKERS})"
+        help=f"并行工作线程数 (默认: {DEFAULT_WORKERS})"
     )
     parser.add_argument(
         "--warmup",
@@ -187,6 +330,18 @@ def main():
         default=DEFAULT_SIMULATION,
         help=f"模拟指令数 (默认: {DEFAULT_SIMULATION})"
     )
+    parser.add_argument(
+        "--decompress-dir",
+        type=str,
+        default=None,
+        help="运行前将trace预先解压到该目录（建议使用本地快速磁盘），每个trace只解压一次 (默认: 不解压)"
+    )
+    parser.add_argument(
+        "--decompress-cap-gb",
+        type=float,
+        default=None,
+        help="预先解压文件的总大小上限(GB)，超出部分的trace直接读取压缩文件 (默认: 不限制)"
+    )
     parser.add_argument(
         "--skip-existing",
         action="store_true",
@@ -208,6 +363,7 @@ def main():
     
     traces_dir = Path(args.traces_dir)
     stats_dir = Path(args.stats_dir)
+    scratch_dir = Path(args.scratch_dir)
     
     # 检查champsim是否存在
     if not CHAMPSIM_BIN.exists():
@@ -229,77 +385,106 @@ def main():
     
     print(f"找到 {len(traces)} 个trace文件")
     
-    # 生成任务列表
-    tasks = generate_task_list(traces, stats_dir, CHAMPSIM_BIN, 
-                               args.warmup, args.simulation)
-    total_combinations = len(tasks)
+    # 任务按需生成，不预先构建完整列表
+    trace_inputs = None
+    
+    def pending_tasks() -> Iterator[tuple]:
+        tasks = generate_task_list(traces, stats_dir, scratch_dir, CHAMPSIM_BIN,
+                                   args.warmup, args.simulation, trace_inputs)
+        if args.skip_existing:
+            tasks = filter_existing_tasks(tasks, stats_dir)
+        return tasks
+    
+    def make_tasks() -> Iterator[tuple]:
+        return itertools.islice(pending_tasks(), args.limit or None)
+    
+    total_combinations = len(traces) * (len(traces) - 1) // 2
     print(f"共有 {total_combinations} 个组合 (C({len(traces)},2) = {len(traces)}*{len(traces)-1}/2)")
     
-    # 过滤已存在的任务
+    # 过滤已存在的任务（只计数，不保存任务）
+    num_tasks = total_combinations
     if args.skip_existing:
-        tasks = filter_existing_tasks(tasks)
-        skipped = total_combinations - len(tasks)
+        num_tasks = sum(1 for _ in pending_tasks())
+        skipped = total_combinations - num_tasks
         if skipped > 0:
             print(f"跳过 {skipped} 个已存在的结果文件")
     
     # 限制任务数量
     if args.limit:
-        tasks = tasks[:args.limit]
-        print(f"限制运行 {len(tasks)} 个任务")
+        num_tasks = min(num_tasks, args.limit)
+        print(f"限制运行 {num_tasks} 个任务")
     
-    if not tasks:
+    if not num_tasks:
         print("没有任务需要运行")
         return
     
     # 创建输出目录
     os.makedirs(stats_dir, exist_ok=True)
+    os.makedirs(scratch_dir, exist_ok=True)
     
     # Dry run模式
     if args.dry_run:
-        print(f"\n将要运行的任务 (共 {len(tasks)} 个):")
+        print(f"\n将要运行的任务 (共 {num_tasks} 个):")
         print("-" * 60)
-        for i, task in enumerate(tasks[:20]):
-            trace1, trace2 = task[0], task[1]
-            print(f"  {i+1:4d}. {get_trace_name(trace1)} + {get_trace_name(trace2)}")
-        if len(tasks) > 20:
-            print(f"  ... 还有 {len(tasks) - 20} 个任务")
+        for i, task in enumerate(itertools.islice(make_tasks(), 20)):
+            name1, name2 = task[2], task[3]
+            print(f"  {i+1:4d}. {name1} + {name2}")
+        if num_tasks > 20:
+            print(f"  ... 还有 {num_tasks - 20} 个任务")
         print("-" * 60)
         print(f"输出目录: {stats_dir}")
-        print(f"使用 --workers {args.workers} 个并行进程")
+        print(f"使用 --workers {args.workers} 个并行线程")
         return
     
+    # 预先解压本次运行用到的trace
+    if args.decompress_dir:
+        if shutil.which("xz") is None:
+            print("警告: 未找到 xz 命令，跳过预先解压")
+        else:
+            used_traces = sorted({trace for task in make_tasks() for trace in task[:2]})
+            cap_bytes = int(args.decompress_cap_gb * 1024**3) if args.decompress_cap_gb is not None else None
+            print(f"\n预先解压 {len(used_traces)} 个trace到 {args.decompress_dir} ...")
+            trace_inputs = decompress_traces(used_traces, Path(args.decompress_dir), cap_bytes,
+                                             os.cpu_count() or 1)
+            print(f"已解压 {len(trace_inputs)} 个trace，其余直接读取压缩文件")
+    
     # 运行模拟
-    print(f"\n使用 {args.workers} 个进程并行运行 {len(tasks)} 个模拟任务...")
+    print(f"\n使用 {args.workers} 个线程并行运行 {num_tasks} 个模拟任务...")
     print("=" * 70)
     
     start_time = time.time()
     completed = 0
     failed = 0
     
-    with ProcessPoolExecutor(max_workers=args.workers) as executor:
-        # 提交所有任务
-        future_to_task = {executor.submit(run_simulation, task): task for task in tasks}
+    # 进度信息交给单独的输出线程打印，调度循环只负责计数
+    progress = queue.Queue()
+    printer = threading.Thread(target=print_progress,
+                               args=(progress, num_tasks, start_time, args.workers), daemon=True)
+    printer.start()
+    
+    tasks = make_tasks()
+    # 每个任务只是等待ChampSim子进程结束（期间释放GIL），用线程即可，无需额外的Python进程
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # 只保持有限个已提交的任务，每完成一个再提交下一个
+        pending = {executor.submit(run_simulation, task)
+                   for task in itertools.islice(tasks, MAX_IN_FLIGHT_PER_WORKER * args.workers)}
         
         # 处理完成的任务
-        for future in as_completed(future_to_task):
-            result = future.result()
-            completed += 1
-            
-            if result["success"]:
-                status = "✓"
-            else:
-                status = "✗"
-                failed += 1
-            
-            elapsed = time.time() - start_time
-            avg_time = elapsed / completed if completed > 0 else 0
-            remaining = (len(tasks) - completed) * avg_time / args.workers
-            
-            print(f"[{completed:4d}/{len(tasks)}] {status} {result['trace1']} + {result['trace2']} "
-                  f"({result['duration']:.1f}s) - 预计剩余: {remaining/60:.1f}分钟")
-            
-            if not result["success"]:
-                print(f"         错误: {result['error']}")
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                next_task = next(tasks, None)
+                if next_task is not None:
+                    pending.add(executor.submit(run_simulation, next_task))
+                
+                result = future.result()
+                completed += 1
+                if not result["success"]:
+                    failed += 1
+                progress.put((completed, result))
+    
+    progress.put(None)
+    printer.join()
     
     # 输出统计
     total_time = time.time() - start_time